@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # vim: noet sw=4 ts=4:
 
-# Enter/exit tracing decorator for Python >= 2.7 and >= 3.0
+# Enter/exit tracing decorator for Python >= 3.7
 #
 # Copyright (c) 2012 Kyle George <kgeorge@tcpsoft.com>
 #
@@ -21,21 +21,126 @@
 
 from __future__ import print_function
 
-from collections import Iterable, OrderedDict
+from collections.abc import Iterable
 import functools
-import inspect
+import logging
+import textwrap
 import time
+import types
+
+# code object flags, as in inspect
+_CO_VARARGS = 0x04
+_CO_VARKEYWORDS = 0x08
+
+_clock_ns = time.perf_counter_ns
+_timing_fmt = ' (%d usecs)'
+
+_unset = object()
+
+# Types whose equal values always have the same repr.
+_memo_types = frozenset((int, str, bytes, bool, type(None)))
+
+_log_levels = {
+  'debug': logging.DEBUG,
+  'info': logging.INFO,
+  'warning': logging.WARNING,
+  'warn': logging.WARNING,
+  'error': logging.ERROR,
+  'exception': logging.ERROR,
+  'critical': logging.CRITICAL,
+  'fatal': logging.CRITICAL,
+}
 
 def _repr(name, value):
 	return repr(value)
 
+_callargs_noargs_src = textwrap.dedent("""\
+	def make(xfrm, general):
+		def callargs_repr(args, kwargs):
+			return ''
+		return callargs_repr
+	""")
+
+_callargs_positional_src = textwrap.dedent("""\
+	def make(xfrm, general):
+		def callargs_repr(args, kwargs):
+			if kwargs or len(args) != %(nargs)d:
+				return general(args, kwargs)
+			return %(fmt)r %% %(values)s
+		return callargs_repr
+	""")
+
+_callargs_factories = {}
+
+def _callargs_factory(arg_names, plain_repr=False):
+	"""\
+	Return a factory for an argument formatter specialized to a function
+	taking exactly the fixed positional arguments arg_names.  The factory
+	takes xfrm and the general formatter, used for any other call shape.
+	With plain_repr, xfrm is known to be _repr and values are formatted with
+	%r directly.  Factories are compiled once per argument list and shared.
+	"""
+
+	key = (arg_names, plain_repr)
+	try:
+		return _callargs_factories[key]
+	except KeyError:
+		pass
+	if arg_names and plain_repr:
+		src = _callargs_positional_src % {
+		  'nargs': len(arg_names),
+		  'fmt': ', '.join('%s=%%r' % k for k in arg_names),
+		  'values': 'args',
+		}
+	elif arg_names:
+		src = _callargs_positional_src % {
+		  'nargs': len(arg_names),
+		  'fmt': ', '.join('%s=%%s' % k for k in arg_names),
+		  'values': '(%s,)' % ', '.join('xfrm(%r, args[%d])' % (k, i)
+		    for i, k in enumerate(arg_names)),
+		}
+	else:
+		src = _callargs_noargs_src
+	namespace = {}
+	exec(compile(src, '<trace>', 'exec'), namespace)
+	factory = _callargs_factories[key] = namespace['make']
+	return factory
+
 def trace(out=None, oncall=True, onexception=True, onreturn=True, timing=False,
-  xfrm=_repr):
+  xfrm=_repr, memoize=False, brief=False, output_mode=None):
 	"""\
 	A decorator that traces enter and exit/exception from a function.  It can
 	also be used to hook those same events.
+
+	A list, tuple or set given as oncall/onexception/onreturn is copied when
+	trace() is called; other iterables are checked with "in" on each event.
+
+	With memoize, the formatted arguments of recent calls are cached and
+	reused when the function is called again with equal arguments.  Only
+	calls whose arguments are all int, str, bytes, bool or None (exactly) are
+	cached; others are formatted every time.  Only use it when xfrm is
+	deterministic for such arguments; the cache can be dropped with the
+	wrapper's cache_clear().
+
+	With brief, arguments left at their default values are not shown (nor
+	passed to xfrm); only the arguments supplied by the caller are.
+
+	With output_mode='batched', the entr message is held back and written
+	together with the exit/excp message in a single call to out, joined by
+	a newline.  Output from nested traced calls then appears before the
+	entr message of the outer call.
+
+	When out is a level method of a logger (e.g. log.info), nothing is
+	formatted or output while the logger is not enabled for that level;
+	oncall/onexception/onreturn are still called.  Any other out callable
+	can opt in by carrying _trace_logger (an object with isEnabledFor(), such
+	as a Logger) and _trace_level attributes.
 	"""
 
+	if output_mode not in (None, 'batched'):
+		raise ValueError('unknown output_mode %r' % (output_mode,))
+	batched = output_mode == 'batched'
+
 	if not out:
 		def _out(*args):
 			for arg in args:
@@ -45,94 +150,244 @@ def trace(out=None, oncall=True, onexception=True, onreturn=True, timing=False,
 	else:
 		output = out
 
-	def match(onX, val):
+	enabled = None
+	logger = getattr(out, '_trace_logger', None)
+	level = getattr(out, '_trace_level', None)
+	if logger is None:
+		logger = getattr(out, '__self__', None)
+		if level is None:
+			level = _log_levels.get(getattr(out, '__name__', None))
+	if level is not None and hasattr(logger, 'isEnabledFor'):
+		enabled = functools.partial(logger.isEnabledFor, level)
+	# the default xfrm is just repr(), which % can apply without a call
+	plain_repr = xfrm is _repr
+
+	def live(onX):
+		# Iterables other than these are checked with "in" on every event,
+		# so they can change after trace() is called.
+		return isinstance(onX, Iterable) and not callable(onX) and \
+		  not isinstance(onX, (str, bytes, list, tuple, set, frozenset))
+
+	def matcher(onX):
+		if live(onX):
+			# tested for emptiness per event, like the original
+			return lambda val: bool(onX) and val in onX
 		if not onX:
-			return False
+			return lambda val: False
 		if onX is True:
-			return True
+			return lambda val: True
 		if callable(onX):
-			return onX(val)
-		if isinstance(onX, Iterable):
-			return val in onX
-		return onX == val
+			return onX
+		if isinstance(onX, (list, tuple, set, frozenset)):
+			# snapshot, taken when trace() is called
+			members = tuple(onX)
+			try:
+				hashed = frozenset(members)
+			except TypeError:
+				return lambda val: val in members
+			def match(val):
+				try:
+					return val in hashed
+				except TypeError:
+					# unhashable val
+					return val in members
+			return match
+		if isinstance(onX, (str, bytes)):
+			return lambda val: val in onX
+		return lambda val: onX == val
+
+	# Nothing can ever be traced, unless a live filter is filled in later.
+	silent = not (oncall or onexception or onreturn) and \
+	  not (live(oncall) or live(onexception) or live(onreturn))
+
+	match_call = matcher(oncall)
+	match_exception = matcher(onexception)
+	match_return = matcher(onreturn)
 
 	def trace_(func):
-		argspec = inspect.getargspec(func)
-
-		defaults = [None] * len(argspec.args)
-		if argspec.defaults:
-			defaults = [None] * (len(argspec.args) - len(argspec.defaults))
-			defaults.extend(argspec.defaults)
-		args_defaults = [list(i) for i in zip(argspec.args, defaults)]
-
-		def callargs_repr(*args, **kwargs):
-			args_position = [None] * (len(argspec.args) - len(args))
-			args_position = list(args[0:len(argspec.args)]) + args_position
-			args_data = [[x[0][0], x[0][1] if x[1] is None else x[1]] \
-			  for x in zip(args_defaults, args_position)]
-			args_data = OrderedDict(args_data)
-			for k, v in kwargs.items():
-				if k in args_data:
-					args_data[k] = v
+		# Read the arguments straight from the code object: positional
+		# (positional-only first), keyword-only, then the *args and
+		# **kwargs names.  Callables without one (builtins, partials, ...)
+		# are reported as taking (*args, **kwargs).
+		# Check for a bound method at every step: it forwards __wrapped__
+		# to its function, which would lose the bound self.
+		code_func = func
+		bound = 0
+		seen = set([id(code_func)])
+		while True:
+			if isinstance(code_func, types.MethodType):
+				code_func = code_func.__func__
+				bound += 1
+			elif hasattr(code_func, '__wrapped__'):
+				code_func = code_func.__wrapped__
+			else:
+				break
+			if id(code_func) in seen:
+				raise ValueError('wrapper loop when unwrapping %r' % (func,))
+			seen.add(id(code_func))
+		co = getattr(code_func, '__code__', None)
+		if co is None:
+			arg_names = ()
+			defaults = ()
+			nargs = nposonly = 0
+			varargs_name = '*args'
+			varkwargs_name = '**kwargs'
+		else:
+			nargs = co.co_argcount
+			nposonly = getattr(co, 'co_posonlyargcount', 0)
+			nkwonly = co.co_kwonlyargcount
+			arg_names = co.co_varnames[:nargs + nkwonly]
+			pos_defaults = code_func.__defaults__ or ()
+			kw_defaults = code_func.__kwdefaults__ or {}
+			defaults = (None,) * (nargs - len(pos_defaults)) + \
+			  pos_defaults + tuple(kw_defaults.get(k) for k in \
+			  arg_names[nargs:])
+			i = nargs + nkwonly
+			varargs_name = None
+			if co.co_flags & _CO_VARARGS:
+				varargs_name = '*%s' % co.co_varnames[i]
+				i += 1
+			varkwargs_name = None
+			if co.co_flags & _CO_VARKEYWORDS:
+				varkwargs_name = '**%s' % co.co_varnames[i]
+			# self is already bound and never passed to the wrapper
+			arg_names = arg_names[bound:]
+			defaults = defaults[bound:]
+			nargs -= bound
+			nposonly = max(nposonly - bound, 0)
+		arg_index = dict((k, i) for i, k in enumerate(arg_names)
+		  if i >= nposonly)
+		if brief:
+			defaults = (_unset,) * len(arg_names)
+		else:
+			defaults = tuple(defaults)
+
+		# One output slot per argument, then *args, then **kwargs.
+		varargs_slot = len(arg_names)
+		varkwargs_slot = varargs_slot + (1 if varargs_name else 0)
+		nslots = varkwargs_slot + (1 if varkwargs_name else 0)
+
+		def callargs_repr(args, kwargs):
+			values = list(defaults)
+			if len(args) > nargs:
+				values[:nargs] = args[:nargs]
+			else:
+				values[:len(args)] = args
 			varkwargs = {}
-			for k in (set(kwargs.keys()) - set(args_data.keys())):
-				varkwargs[k] = kwargs[k]
-			varargs = args[len(argspec.args):]
-			arglist = ['%s=%s' % (k, xfrm(k, v)) for k, v in \
-			  args_data.items()]
-			if argspec.varargs:
-				name = '*%s' % argspec.varargs
-				arglist.append('%s=%s' % (name, xfrm(name, varargs)))
-			if argspec.keywords:
-				name = '**%s' % argspec.keywords
-				arglist.append('%s=%s' % (name, xfrm(name, varkwargs)))
+			for k, v in kwargs.items():
+				i = arg_index.get(k)
+				if i is None:
+					varkwargs[k] = v
+				else:
+					values[i] = v
+			arglist = [None] * nslots
+			for i, k in enumerate(arg_names):
+				v = values[i]
+				if v is not _unset:
+					if plain_repr:
+						arglist[i] = '%s=%r' % (k, v)
+					else:
+						arglist[i] = '%s=%s' % (k, xfrm(k, v))
+			if varargs_name:
+				arglist[varargs_slot] = '%s=%s' % (varargs_name,
+				  xfrm(varargs_name, args[nargs:]))
+			if varkwargs_name:
+				arglist[varkwargs_slot] = '%s=%s' % (varkwargs_name,
+				  xfrm(varkwargs_name, varkwargs))
+			if brief:
+				arglist = [a for a in arglist if a is not None]
 			result = ', '.join(arglist)
 			return result
 
-		@functools.wraps(func)
+		if len(arg_names) == nargs and not (varargs_name or varkwargs_name):
+			callargs_repr = _callargs_factory(arg_names, plain_repr)(xfrm,
+			  callargs_repr)
+
+		callargs_fmt = callargs_repr
+		if memoize:
+			@functools.lru_cache(maxsize=128, typed=True)
+			def callargs_cached(*args, **kwargs):
+				return callargs_repr(args, kwargs)
+
+			def callargs_fmt(args, kwargs):
+				for v in args:
+					if type(v) not in _memo_types:
+						return callargs_repr(args, kwargs)
+				for v in kwargs.values():
+					if type(v) not in _memo_types:
+						return callargs_repr(args, kwargs)
+				return callargs_cached(*args, **kwargs)
+
+		fname = getattr(func, '__name__', type(func).__name__)
+		fname = fname.replace('%', '%%')
+		entr_fmt = 'entr ' + fname + '(%s)'
+		excp_fmt = 'excp ' + fname + ' raised %s %s%s'
+		cexp_fmt = 'cexp ' + fname + '(%s) raised %s %s%s'
+		exit_fmt = 'exit ' + fname + '=%s%s'
+		call_fmt = 'call ' + fname + '(%s)=%s%s'
+
 		def trace__(*args, **kwargs):
+			if silent:
+				return func(*args, **kwargs)
+			emit = enabled is None or enabled()
+
 			entr_done = False
+			pending = None
 			timing_str = ''
-			timing_fmt = ' (%d usecs)'
 
-			def callargs_str():
-				try:
-					return callargs_str._saved
-				except:
-					callargs_str._saved = callargs_repr(args, kwargs)
-					return callargs_str._saved
-
-			if match(oncall, (args, kwargs)):
-				output('entr %s(%s)' % (func.__name__, callargs_str()))
+			if match_call((args, kwargs)) and emit:
+				if batched:
+					pending = entr_fmt % callargs_fmt(args, kwargs)
+				else:
+					output(entr_fmt % callargs_fmt(args, kwargs))
 				entr_done = True
 			try:
 				if timing:
-					start_time = time.time() * 1e6
+					start_time = _clock_ns()
 				retval = func(*args, **kwargs)
 				if timing:
-					end_time = time.time() * 1e6
-					timing_str = timing_fmt % (end_time - start_time)
+					timing_str = _timing_fmt % \
+					  ((_clock_ns() - start_time) // 1000)
 			except Exception as e:
 				if timing:
-					end_time = time.time() * 1e6
-					timing_str = timing_fmt % (end_time - start_time)
-				if match(onexception, e):
+					timing_str = _timing_fmt % \
+					  ((_clock_ns() - start_time) // 1000)
+				if match_exception(e) and emit:
 					if entr_done:
-						output('excp %s raised %s %s%s' % (func.__name__,
-						  e.__class__.__name__, str(e), timing_str))
+						msg = excp_fmt % (e.__class__.__name__, str(e),
+						  timing_str)
 					else:
-						output('cexp %s(%s) raised %s %s%s' % (func.__name__,
-						  callargs_str(), e.__class__.__name__, str(e),
-						  timing_str))
+						msg = cexp_fmt % (callargs_fmt(args, kwargs),
+						  e.__class__.__name__, str(e), timing_str)
+					if pending is not None:
+						msg = pending + '\n' + msg
+					output(msg)
+				elif pending is not None:
+					output(pending)
 				raise
-			if match(onreturn, retval):
+			except BaseException:
+				if pending is not None:
+					output(pending)
+				raise
+			if match_return(retval) and emit:
 				if entr_done:
-					output('exit %s=%s%s' % (func.__name__,
-					  xfrm(None, retval), timing_str))
+					msg = exit_fmt % (xfrm(None, retval), timing_str)
 				else:
-					output('call %s(%s)=%s%s' % (func.__name__,
-					  callargs_str(), xfrm(None, retval), timing_str))
+					msg = call_fmt % (callargs_fmt(args, kwargs),
+					  xfrm(None, retval), timing_str)
+				if pending is not None:
+					msg = pending + '\n' + msg
+				output(msg)
+			elif pending is not None:
+				output(pending)
 			return retval
+
+		# Like functools.wraps(), but without copying func.__dict__.
+		functools.update_wrapper(trace__, func, updated=())
+		if not hasattr(func, '__name__'):
+			trace__.__name__ = trace__.__qualname__ = type(func).__name__
+		if memoize:
+			trace__.cache_clear = callargs_cached.cache_clear
 		return trace__
 	return trace_
 
@@ -192,6 +447,13 @@ if __name__ == '__main__':
 		  kw1=[0, 1, {'b': 'dict'}])
 		return 'outer'
 
+	class Abcd9(object):
+		@trace()
+		def method(self, x=None):
+			return x
+
+	abcd9 = trace()(Abcd9().method)
+
 	abcd0()
 	abcd1(0, 1, 2)
 	abcd2(0, b=99, randomarg=-1)
@@ -214,4 +476,4 @@ if __name__ == '__main__':
 	abcd6(0, 100, 101, 102, 103, 104, 105, ['a', 'list'], {'a': 'dict'},
 	  x=12, y=13)
 	abcd8(0)
-
+	abcd9(3)